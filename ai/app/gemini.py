@@ -0,0 +1,489 @@
+from __future__ import annotations
+
+import asyncio
+import re
+import uuid
+from collections.abc import AsyncIterator, Awaitable, Callable
+from time import monotonic
+from typing import Any
+
+import httpx
+import orjson
+
+from .models import DailyInsightsBatchStatus, DailyInsightsRequest, DailyInsightsResponse
+from .settings import ALLOW_GEMINI_FALLBACK, GEMINI_API_KEY, GEMINI_MODELS, GEMINI_SERVICE_TIER
+
+GEMINI_API_BASE = 'https://generativelanguage.googleapis.com/v1beta'
+HTTP_MAX_CONNECTIONS = 20
+HTTP_KEEPALIVE_SECONDS = 60.0
+JSON_HEADERS = {'Content-Type': 'application/json'}
+BATCH_FLUSH_SECONDS = 60.0
+BATCH_MAX_ITEMS = 100
+BATCH_POLL_SECONDS = 30.0
+BATCH_POLL_MAX_SECONDS = 24 * 60 * 60
+BATCH_JOB_TTL_SECONDS = 60 * 60
+
+LEADING_WHITESPACE = re.compile(r'\s*')
+
+DAILY_INSIGHTS_INSTRUCTIONS = (
+    'You are a hospital operations analytics assistant. '
+    'Generate a concise daily executive summary for patient flow and queue performance. '
+    'Use only the provided metrics and do not invent data. '
+    'Provide practical recommendations for administrators and clinical operations leaders. '
+    'Return only strict JSON with this schema: '
+    '{"executive_summary": string, "bullet_actions": string[3..6]}. '
+    'The executive summary must be 1-2 short paragraphs. '
+)
+
+_http: httpx.AsyncClient | None = None
+_batch_queue: asyncio.Queue[tuple[str, DailyInsightsRequest]] | None = None
+_batch_jobs: dict[str, DailyInsightsBatchStatus] = {}
+# finished submission_id -> monotonic expiry, in finishing order
+_batch_job_expiry: dict[str, float] = {}
+_background_tasks: set[asyncio.Task[None]] = set()
+
+
+async def init_gemini() -> None:
+    """Open the shared HTTP client and start the batch worker."""
+
+    global _http, _batch_queue
+    _http = httpx.AsyncClient(
+        timeout=25,
+        http2=True,
+        limits=httpx.Limits(
+            max_connections=HTTP_MAX_CONNECTIONS,
+            max_keepalive_connections=HTTP_MAX_CONNECTIONS,
+            keepalive_expiry=HTTP_KEEPALIVE_SECONDS,
+        ),
+    )
+    _batch_queue = asyncio.Queue()
+    spawn_background(daily_insights_batch_worker(_http, _batch_queue))
+
+
+async def close_gemini() -> None:
+    global _http, _batch_queue
+    for task in list(_background_tasks):
+        task.cancel()
+    await asyncio.gather(*_background_tasks, return_exceptions=True)
+    _batch_queue = None
+    if _http is not None:
+        await _http.aclose()
+        _http = None
+
+
+async def get_http_client() -> httpx.AsyncClient:
+    if _http is None:
+        raise RuntimeError('HTTP client is not initialized')
+    return _http
+
+
+def spawn_background(coro: Awaitable[None]) -> asyncio.Task[None]:
+    task = asyncio.ensure_future(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task
+
+
+def _extract_metrics(date: str, metrics: dict[str, Any]) -> dict[str, Any]:
+    """Normalize the raw metrics payload once for both the prompt and the fallback."""
+
+    return {
+        'date': date,
+        'total_visits': int(metrics.get('total_visits', 0) or 0),
+        'avg_wait_minutes': float(metrics.get('avg_wait', 0) or 0),
+        'peak_time': str(metrics.get('peak_time', 'N/A')),
+        'top_overloaded_spid': str(metrics.get('top_overloaded_spid', 'N/A')),
+        'top_doctor_queue': str(metrics.get('top_doctor_queue', 'N/A')),
+        'yesterday_avg_wait': metrics.get('yesterday_avg_wait'),
+    }
+
+
+def generate_fallback_daily_insights(date: str, metrics: dict[str, Any]) -> DailyInsightsResponse:
+    extracted = _extract_metrics(date, metrics)
+    total_visits = extracted['total_visits']
+    avg_wait = extracted['avg_wait_minutes']
+    peak_time = extracted['peak_time']
+    top_spid = extracted['top_overloaded_spid']
+    top_doctor_queue = extracted['top_doctor_queue']
+    yesterday_wait = extracted['yesterday_avg_wait']
+
+    trend_sentence = ''
+    if yesterday_wait is not None:
+        y = float(yesterday_wait)
+        if avg_wait > y:
+            trend_sentence = f'Average wait increased from {y:.1f} to {avg_wait:.1f} minutes versus yesterday.'
+        elif avg_wait < y:
+            trend_sentence = f'Average wait improved from {y:.1f} to {avg_wait:.1f} minutes versus yesterday.'
+        else:
+            trend_sentence = f'Average wait was unchanged at {avg_wait:.1f} minutes versus yesterday.'
+
+    summary = (
+        f'Operational summary for {date[:10]}: {total_visits} visits with average wait {avg_wait:.1f} minutes. '
+        f'Peak congestion occurred near {peak_time}, mostly in clinic {top_spid}, with highest doctor queue on {top_doctor_queue}. '
+        f'{trend_sentence}'.strip()
+    )
+
+    actions = [
+        f'Reassign support staff to {top_spid} during {peak_time} ± 30 minutes.',
+        'Trigger near-turn notifications earlier when predicted wait drops below 12 minutes.',
+        f'Review queue balancing for {top_doctor_queue} and shift non-urgent follow-ups to same-SPID peers.',
+        'Open temporary overflow slot if queue exceeds 8 patients for more than 20 minutes.',
+    ]
+
+    return DailyInsightsResponse(executive_summary=summary, bullet_actions=actions)
+
+
+def build_daily_insights_prompt(date: str, metrics: dict[str, Any]) -> str:
+    return DAILY_INSIGHTS_INSTRUCTIONS + 'Metrics: ' + orjson.dumps(_extract_metrics(date, metrics)).decode('utf-8')
+
+
+def extract_json_from_text(raw_text: str) -> dict[str, Any]:
+    # orjson skips surrounding whitespace itself; only look past leading
+    # whitespace to detect a ``` fence and slice the object out once.
+    start = LEADING_WHITESPACE.match(raw_text).end()
+
+    if raw_text.startswith('```', start):
+        first_brace = raw_text.find('{', start)
+        last_brace = raw_text.rfind('}')
+        if first_brace != -1 and last_brace != -1 and last_brace > first_brace:
+            raw_text = raw_text[first_brace:last_brace + 1]
+
+    return orjson.loads(raw_text)
+
+
+def build_gemini_request_body(prompt: str, service_tier: str | None = None) -> dict[str, Any]:
+    request_body: dict[str, Any] = {
+        'contents': [
+            {
+                'parts': [
+                    {
+                        'text': prompt,
+                    }
+                ]
+            }
+        ],
+        'generationConfig': {
+            'temperature': 0.3,
+            'responseMimeType': 'application/json',
+        },
+    }
+    if service_tier:
+        request_body['generationConfig']['serviceTier'] = service_tier
+    return request_body
+
+
+async def request_gemini_json(
+    *, client: httpx.AsyncClient, api_key: str, model: str, prompt: str
+) -> dict[str, Any]:
+    endpoint = f'{GEMINI_API_BASE}/models/{model}:generateContent?key={api_key}'
+
+    request_body = build_gemini_request_body(prompt, service_tier=GEMINI_SERVICE_TIER)
+    response = await client.post(endpoint, content=orjson.dumps(request_body), headers=JSON_HEADERS)
+    response.raise_for_status()
+    return orjson.loads(response.content)
+
+
+def extract_candidate_text(response_data: dict[str, Any]) -> str:
+    candidates = response_data.get('candidates') or []
+    if not candidates:
+        return ''
+    parts = ((candidates[0].get('content') or {}).get('parts')) or []
+    return ''.join(str(part.get('text', '')) for part in parts)
+
+
+def parse_daily_insights_response(response_data: dict[str, Any]) -> DailyInsightsResponse:
+    if not response_data.get('candidates'):
+        raise RuntimeError('Gemini API returned no candidates')
+    return parse_daily_insights_text(extract_candidate_text(response_data))
+
+
+def parse_daily_insights_text(generated_text: str) -> DailyInsightsResponse:
+    if not generated_text or generated_text.isspace():
+        raise RuntimeError('Gemini API returned an empty response')
+
+    parsed = extract_json_from_text(generated_text)
+    executive_summary = str(parsed.get('executive_summary', '')).strip()
+    bullet_actions = [str(item).strip() for item in (parsed.get('bullet_actions') or []) if str(item).strip()]
+
+    if not executive_summary:
+        raise RuntimeError('Gemini response missing executive_summary')
+    if len(bullet_actions) < 3:
+        raise RuntimeError('Gemini response must include at least 3 bullet_actions')
+
+    return DailyInsightsResponse(executive_summary=executive_summary, bullet_actions=bullet_actions[:6])
+
+
+async def call_gemini_candidates(attempt: Callable[[str], Awaitable[Any]]) -> Any:
+    """Run attempt(model) for each GEMINI_MODELS candidate and return the first success.
+
+    Candidates are tried one at a time, in order: only a 404 (model unavailable for this
+    key) moves on, so a healthy primary costs exactly one billed request and always wins.
+    Any other HTTP or network error stops at the failing model.
+    """
+
+    last_http_error: str | None = None
+    last_network_error: str | None = None
+
+    for model in GEMINI_MODELS:
+        try:
+            return await attempt(model)
+        except httpx.HTTPStatusError as ex:
+            status_code = ex.response.status_code
+            if status_code == 404:
+                continue
+            last_http_error = f'Gemini API request failed with HTTP {status_code}: {ex.response.text}'
+            break
+        except httpx.RequestError as ex:
+            last_network_error = f'Gemini API network error: {ex}'
+            break
+
+    if last_http_error:
+        raise RuntimeError(last_http_error)
+    if last_network_error:
+        raise RuntimeError(last_network_error)
+    raise RuntimeError('No supported Gemini model found. Set GEMINI_MODEL in ai/.env to a valid model from your account.')
+
+
+async def generate_daily_insights_with_gemini(
+    client: httpx.AsyncClient, date: str, metrics: dict[str, Any]
+) -> DailyInsightsResponse:
+    if not GEMINI_API_KEY:
+        raise RuntimeError('GEMINI_API_KEY is required for /daily-insights')
+
+    prompt = build_daily_insights_prompt(date=date, metrics=metrics)
+    response_data = await call_gemini_candidates(
+        lambda model: request_gemini_json(client=client, api_key=GEMINI_API_KEY, model=model, prompt=prompt)
+    )
+    return parse_daily_insights_response(response_data)
+
+
+async def stream_gemini_text(
+    *, client: httpx.AsyncClient, api_key: str, model: str, prompt: str
+) -> AsyncIterator[str]:
+    """Yield generated text fragments from streamGenerateContent as they arrive."""
+
+    endpoint = f'{GEMINI_API_BASE}/models/{model}:streamGenerateContent?alt=sse&key={api_key}'
+    request_body = build_gemini_request_body(prompt, service_tier=GEMINI_SERVICE_TIER)
+
+    async with client.stream('POST', endpoint, content=orjson.dumps(request_body), headers=JSON_HEADERS) as response:
+        if response.is_error:
+            await response.aread()
+            response.raise_for_status()
+        async for line in response.aiter_lines():
+            if not line.startswith('data:'):
+                continue
+            text = extract_candidate_text(orjson.loads(line[5:]))
+            if text:
+                yield text
+
+
+async def open_gemini_stream(
+    *, client: httpx.AsyncClient, api_key: str, model: str, prompt: str
+) -> tuple[str, AsyncIterator[str]]:
+    """Start streaming from model and return its first fragment with the rest of the stream.
+
+    Pulling the first fragment surfaces HTTP and network errors before anything has been
+    sent to the caller, so call_gemini_candidates can still move on to the next model.
+    """
+
+    stream = stream_gemini_text(client=client, api_key=api_key, model=model, prompt=prompt)
+    try:
+        first = await stream.__anext__()
+    except StopAsyncIteration:
+        first = ''
+    return first, stream
+
+
+def format_sse(event: str, data: Any) -> bytes:
+    return b'event: ' + event.encode('utf-8') + b'\ndata: ' + orjson.dumps(data) + b'\n\n'
+
+
+async def stream_daily_insights(
+    client: httpx.AsyncClient, date: str, metrics: dict[str, Any], allow_fallback: bool
+) -> AsyncIterator[bytes]:
+    """Server-sent events for /daily-insights/stream.
+
+    Emits `chunk` events with raw model text while Gemini generates, then a single
+    `result` event with the validated DailyInsightsResponse (or the local fallback),
+    or an `error` event when fallback is disabled.
+    """
+
+    generated: list[str] = []
+    try:
+        if not GEMINI_API_KEY:
+            raise RuntimeError('GEMINI_API_KEY is required for /daily-insights')
+
+        prompt = build_daily_insights_prompt(date=date, metrics=metrics)
+        first, stream = await call_gemini_candidates(
+            lambda model: open_gemini_stream(client=client, api_key=GEMINI_API_KEY, model=model, prompt=prompt)
+        )
+        if first:
+            generated.append(first)
+            yield format_sse('chunk', {'text': first})
+        async for text in stream:
+            generated.append(text)
+            yield format_sse('chunk', {'text': text})
+
+        result = parse_daily_insights_text(''.join(generated))
+    except (RuntimeError, ValueError, httpx.HTTPError) as ex:
+        if not allow_fallback:
+            yield format_sse('error', {'detail': str(ex)})
+            return
+        result = generate_fallback_daily_insights(date=date, metrics=metrics)
+
+    yield format_sse('result', result.model_dump())
+
+
+def resolve_batch_insights(
+    submission_id: str,
+    request: DailyInsightsRequest,
+    result: DailyInsightsResponse | None = None,
+    error: str | None = None,
+) -> None:
+    if result is not None:
+        update = {'status': 'succeeded', 'result': result}
+    elif ALLOW_GEMINI_FALLBACK:
+        fallback = generate_fallback_daily_insights(date=request.date, metrics=request.metrics)
+        update = {'status': 'succeeded', 'result': fallback, 'error': error}
+    else:
+        update = {'status': 'failed', 'error': error}
+    _batch_jobs[submission_id] = _batch_jobs[submission_id].model_copy(update=update)
+    _batch_job_expiry[submission_id] = monotonic() + BATCH_JOB_TTL_SECONDS
+
+
+def prune_batch_jobs() -> None:
+    """Forget finished jobs once their results have been readable for BATCH_JOB_TTL_SECONDS."""
+
+    now = monotonic()
+    for submission_id, expiry in list(_batch_job_expiry.items()):
+        if expiry > now:
+            break
+        del _batch_job_expiry[submission_id]
+        _batch_jobs.pop(submission_id, None)
+
+
+async def daily_insights_batch_worker(
+    client: httpx.AsyncClient, queue: asyncio.Queue[tuple[str, DailyInsightsRequest]]
+) -> None:
+    """Drain queued /daily-insights/batch requests into Gemini batch jobs.
+
+    A batch is flushed once it holds BATCH_MAX_ITEMS requests or BATCH_FLUSH_SECONDS
+    after its first request arrived, whichever comes first.
+    """
+
+    loop = asyncio.get_running_loop()
+    while True:
+        items = [await queue.get()]
+        deadline = loop.time() + BATCH_FLUSH_SECONDS
+        while len(items) < BATCH_MAX_ITEMS:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            try:
+                items.append(await asyncio.wait_for(queue.get(), remaining))
+            except asyncio.TimeoutError:
+                break
+
+        try:
+            batch_name = await submit_daily_insights_batch(client, items)
+        except (RuntimeError, ValueError, httpx.HTTPError) as ex:
+            for submission_id, request in items:
+                resolve_batch_insights(submission_id, request, error=f'Gemini batch submission failed: {ex}')
+            continue
+
+        for submission_id, _ in items:
+            _batch_jobs[submission_id] = _batch_jobs[submission_id].model_copy(
+                update={'status': 'submitted', 'batch_name': batch_name}
+            )
+        spawn_background(poll_daily_insights_batch(client, batch_name, dict(items)))
+
+
+async def submit_daily_insights_batch(
+    client: httpx.AsyncClient, items: list[tuple[str, DailyInsightsRequest]]
+) -> str:
+    if not GEMINI_API_KEY:
+        raise RuntimeError('GEMINI_API_KEY is required for /daily-insights/batch')
+
+    model = GEMINI_MODELS[0]
+    request_body = {
+        'batch': {
+            'display_name': f'daily-insights-{uuid.uuid4().hex[:8]}',
+            'input_config': {
+                'requests': {
+                    'requests': [
+                        {
+                            'request': build_gemini_request_body(
+                                build_daily_insights_prompt(date=request.date, metrics=request.metrics)
+                            ),
+                            'metadata': {'key': submission_id},
+                        }
+                        for submission_id, request in items
+                    ]
+                }
+            },
+        }
+    }
+
+    response = await client.post(f'{GEMINI_API_BASE}/models/{model}:batchGenerateContent?key={GEMINI_API_KEY}', json=request_body)
+    response.raise_for_status()
+    batch_name = response.json().get('name')
+    if not batch_name:
+        raise RuntimeError('Gemini batch API returned no batch name')
+    return batch_name
+
+
+async def poll_daily_insights_batch(
+    client: httpx.AsyncClient, batch_name: str, requests: dict[str, DailyInsightsRequest]
+) -> None:
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + BATCH_POLL_MAX_SECONDS
+    while True:
+        if loop.time() >= deadline:
+            for submission_id, request in requests.items():
+                resolve_batch_insights(submission_id, request, error=f'Gemini batch job {batch_name} did not finish in time')
+            return
+
+        await asyncio.sleep(BATCH_POLL_SECONDS)
+        try:
+            response = await client.get(f'{GEMINI_API_BASE}/{batch_name}?key={GEMINI_API_KEY}')
+            response.raise_for_status()
+            operation = response.json()
+        except (ValueError, httpx.HTTPError):
+            continue
+
+        if operation.get('done'):
+            break
+
+    output = operation.get('response') or (operation.get('metadata') or {}).get('output') or {}
+    inlined = (output.get('inlinedResponses') or {}).get('inlinedResponses') or []
+    error = (operation.get('error') or {}).get('message') or 'Gemini batch job returned no result'
+
+    for item in inlined:
+        submission_id = (item.get('metadata') or {}).get('key')
+        request = requests.pop(submission_id, None)
+        if request is None:
+            continue
+        try:
+            resolve_batch_insights(submission_id, request, result=parse_daily_insights_response(item.get('response') or {}))
+        except (RuntimeError, ValueError) as ex:
+            resolve_batch_insights(submission_id, request, error=str(ex))
+
+    for submission_id, request in requests.items():
+        resolve_batch_insights(submission_id, request, error=error)
+
+
+async def enqueue_daily_insights_batch(payload: DailyInsightsRequest) -> DailyInsightsBatchStatus:
+    if _batch_queue is None:
+        raise RuntimeError('Batch queue is not running')
+
+    prune_batch_jobs()
+    submission_id = uuid.uuid4().hex
+    job = DailyInsightsBatchStatus(submission_id=submission_id, status='queued')
+    _batch_jobs[submission_id] = job
+    await _batch_queue.put((submission_id, payload))
+    return job
+
+
+def get_daily_insights_batch(submission_id: str) -> DailyInsightsBatchStatus | None:
+    prune_batch_jobs()
+    return _batch_jobs.get(submission_id)
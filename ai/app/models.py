@@ -0,0 +1,47 @@
+from __future__ import annotations
+
+from datetime import datetime
+from typing import Any
+
+from pydantic import BaseModel, ConfigDict, Field
+
+
+class PredictWaitRequest(BaseModel):
+    model_config = ConfigDict(frozen=True, extra='forbid')
+
+    doctor_id: str | None = None
+    spid: str | None = None
+    patients_ahead: int = Field(ge=0)
+    current_time: datetime
+
+
+class PredictWaitResponse(BaseModel):
+    model_config = ConfigDict(frozen=True, extra='forbid')
+
+    predicted_minutes: float
+    confidence_low: float
+    confidence_high: float
+
+
+class DailyInsightsRequest(BaseModel):
+    model_config = ConfigDict(frozen=True, extra='forbid')
+
+    date: str
+    metrics: dict[str, Any]
+
+
+class DailyInsightsResponse(BaseModel):
+    model_config = ConfigDict(frozen=True, extra='forbid')
+
+    executive_summary: str
+    bullet_actions: list[str]
+
+
+class DailyInsightsBatchStatus(BaseModel):
+    model_config = ConfigDict(frozen=True, extra='forbid')
+
+    submission_id: str
+    status: str
+    batch_name: str | None = None
+    result: DailyInsightsResponse | None = None
+    error: str | None = None
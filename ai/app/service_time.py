@@ -0,0 +1,276 @@
+from __future__ import annotations
+
+import asyncio
+from collections import Counter, defaultdict
+from collections.abc import Awaitable, Callable, Hashable, Sequence
+from datetime import date, datetime, time, timezone
+from time import monotonic
+from typing import Any
+from uuid import UUID
+
+import numpy as np
+from ciso8601 import parse_datetime
+from postgrest import APIError
+from supabase import AsyncClient
+
+SERVICE_TIME_CACHE_TTL_SECONDS = 60.0
+DOCTOR_SPID_CACHE_TTL_SECONDS = 600.0
+CACHE_MAX_ENTRIES = 1024
+MICRO_BATCH_MAX_KEYS = 32
+MICRO_BATCH_MAX_WAIT_SECONDS = 0.05
+
+GapStats = dict[int, tuple[float, int]]
+
+_service_time_cache: dict[tuple[str, int, date], tuple[float, float]] = {}
+_doctor_spid_cache: dict[str, tuple[str, float]] = {}
+_cache_locks: dict[Hashable, asyncio.Lock] = defaultdict(asyncio.Lock)
+_cache_lock_users: Counter[Hashable] = Counter()
+_midnight_cache: tuple[date, str] = (date.min, '')
+
+
+def utc_today() -> tuple[date, str]:
+    """Return today's UTC date and its midnight ISO timestamp, rebuilt once per day."""
+
+    global _midnight_cache
+    today = datetime.now(timezone.utc).date()
+    if today != _midnight_cache[0]:
+        _midnight_cache = (today, datetime.combine(today, time.min, timezone.utc).isoformat())
+    return _midnight_cache
+
+
+async def cached_async(
+    cache: dict[Any, tuple[Any, float]],
+    key: Hashable,
+    ttl: float,
+    compute: Callable[[], Awaitable[Any]],
+) -> Any:
+    """Return a cached value for key, computing it at most once per TTL.
+
+    A per-key lock makes concurrent misses wait for the first caller instead of
+    all hitting Supabase. None results are not cached.
+    """
+
+    entry = cache.get(key)
+    if entry is not None and monotonic() < entry[1]:
+        return entry[0]
+
+    # Locks live only while someone holds or awaits them, so keys whose value is never
+    # stored (None results) do not leave one behind.
+    lock_key = (id(cache), key)
+    _cache_lock_users[lock_key] += 1
+    try:
+        async with _cache_locks[lock_key]:
+            entry = cache.get(key)
+            if entry is not None and monotonic() < entry[1]:
+                return entry[0]
+
+            value = await compute()
+            now = monotonic()
+            if len(cache) >= CACHE_MAX_ENTRIES:
+                for stale_key in [k for k, (_, expiry) in cache.items() if expiry <= now]:
+                    del cache[stale_key]
+                # Still full of live entries: drop the oldest insertions to stay bounded.
+                for old_key in list(cache)[: len(cache) - CACHE_MAX_ENTRIES + 1]:
+                    del cache[old_key]
+            if value is not None:
+                cache[key] = (value, now + ttl)
+            return value
+    finally:
+        _cache_lock_users[lock_key] -= 1
+        if not _cache_lock_users[lock_key]:
+            del _cache_lock_users[lock_key]
+            del _cache_locks[lock_key]
+
+
+class MicroBatcher:
+    """Coalesce concurrent single-key lookups into one multi-key Supabase call.
+
+    Keys requested within MICRO_BATCH_MAX_WAIT_SECONDS of the first pending key (or
+    until MICRO_BATCH_MAX_KEYS distinct keys are pending) are fetched together by
+    fetch_many, and each caller receives the value for its own key.
+    """
+
+    def __init__(self, fetch_many: Callable[[AsyncClient, list[Any]], Awaitable[dict[Any, Any]]]) -> None:
+        self._fetch_many = fetch_many
+        self._pending: dict[Any, list[asyncio.Future[Any]]] = {}
+        self._sb: AsyncClient | None = None
+        self._timer: asyncio.TimerHandle | None = None
+        self._tasks: set[asyncio.Task[None]] = set()
+
+    async def load(self, sb: AsyncClient, key: Hashable) -> Any:
+        loop = asyncio.get_running_loop()
+        future: asyncio.Future[Any] = loop.create_future()
+        self._sb = sb
+        self._pending.setdefault(key, []).append(future)
+
+        if len(self._pending) >= MICRO_BATCH_MAX_KEYS:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(MICRO_BATCH_MAX_WAIT_SECONDS, self._flush)
+        return await future
+
+    def _flush(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, {}
+        if batch and self._sb is not None:
+            task = asyncio.ensure_future(self._run(self._sb, batch))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, sb: AsyncClient, batch: dict[Any, list[asyncio.Future[Any]]]) -> None:
+        try:
+            results = await self._fetch_many(sb, list(batch))
+        except Exception as ex:
+            for futures in batch.values():
+                for future in futures:
+                    if not future.done():
+                        future.set_exception(ex)
+            return
+
+        for key, futures in batch.items():
+            for future in futures:
+                if not future.done():
+                    future.set_result(results.get(key))
+
+
+async def estimate_service_time(sb: AsyncClient, spid: str, hour: int) -> float:
+    """Estimate average service time per patient by SPID and hour.
+
+    For hackathon speed this infers time gaps between consecutive screening records
+    (same spid, same hour bucket) and falls back to defaults when sparse. Results are
+    cached per (spid, hour, day) for SERVICE_TIME_CACHE_TTL_SECONDS.
+    """
+
+    key = (spid, hour, utc_today()[0])
+    return await cached_async(
+        _service_time_cache,
+        key,
+        SERVICE_TIME_CACHE_TTL_SECONDS,
+        lambda: _compute_service_time(sb, spid=spid, hour=hour),
+    )
+
+
+async def get_spid_for_doctor(sb: AsyncClient, doctor_id: str) -> str | None:
+    return await cached_async(
+        _doctor_spid_cache,
+        doctor_id,
+        DOCTOR_SPID_CACHE_TTL_SECONDS,
+        lambda: _doctor_spid_batcher.load(sb, doctor_id),
+    )
+
+
+async def fetch_doctor_spids(sb: AsyncClient, doctor_ids: list[str]) -> dict[str, str]:
+    # Key by canonical uuid text (what PostgREST returns); a malformed id cannot match a doctor
+    # and would otherwise fail the uuid cast for every caller in the batch.
+    by_canonical_id: dict[str, list[str]] = defaultdict(list)
+    for doctor_id in doctor_ids:
+        try:
+            by_canonical_id[str(UUID(doctor_id))].append(doctor_id)
+        except ValueError:
+            continue
+    if not by_canonical_id:
+        return {}
+
+    doctor_res = await sb.table('doctors').select('id,spid').in_('id', list(by_canonical_id)).execute()
+    # Several spellings (e.g. upper/lower case) of one uuid may be pending; answer all of them.
+    return {
+        doctor_id: row['spid']
+        for row in (doctor_res.data or [])
+        if row.get('spid')
+        for doctor_id in by_canonical_id.get(row['id'], ())
+    }
+
+
+async def fetch_gap_stats_many(sb: AsyncClient, spids: list[str]) -> dict[str, GapStats]:
+    try:
+        return await fetch_gap_stats_rpc(sb, spids)
+    except APIError as ex:
+        # avg_service_gap is missing until supabase/schema.sql is re-applied.
+        if ex.code != 'PGRST202':
+            raise
+        return await fetch_gap_stats_rows(sb, spids)
+
+
+_doctor_spid_batcher = MicroBatcher(fetch_doctor_spids)
+_gap_stats_batcher = MicroBatcher(fetch_gap_stats_many)
+
+
+async def _compute_service_time(sb: AsyncClient, spid: str, hour: int) -> float:
+    gap_stats: GapStats = await _gap_stats_batcher.load(sb, spid) or {}
+
+    hour_stats = gap_stats.get(hour)
+    if hour_stats:
+        total, samples = hour_stats
+        return max(3.0, min(20.0, total / samples))
+
+    total, samples = 0.0, 0
+    for hour_total, hour_samples in gap_stats.values():
+        total += hour_total
+        samples += hour_samples
+    if samples:
+        return max(3.0, min(20.0, total / samples))
+
+    return 7.5
+
+
+async def fetch_gap_stats_rpc(sb: AsyncClient, spids: Sequence[str]) -> dict[str, GapStats]:
+    """Return {spid: {hour: (total_gap_minutes, samples)}} aggregated in Postgres."""
+
+    params = {'p_spids': list(spids), 'p_day': utc_today()[0].isoformat()}
+    result = await sb.rpc('avg_service_gap', params).execute()
+    stats: dict[str, GapStats] = defaultdict(dict)
+    for row in result.data or []:
+        samples = int(row.get('samples') or 0)
+        if samples:
+            stats[row['spid']][int(row['hour'])] = (float(row['avg_gap']) * samples, samples)
+    return stats
+
+
+async def fetch_gap_stats_rows(sb: AsyncClient, spids: Sequence[str]) -> dict[str, GapStats]:
+    """Client-side equivalent of avg_service_gap over today's raw screening rows."""
+
+    # One query per spid: PostgREST's max-rows cap applies per request, so a shared
+    # limit would let busy spids starve the rest of the batch.
+    results = await asyncio.gather(*(fetch_today_screening_times(sb, spid) for spid in spids))
+    return {spid: aggregate_gap_stats(timestamps) for spid, timestamps in zip(spids, results)}
+
+
+async def fetch_today_screening_times(sb: AsyncClient, spid: str) -> np.ndarray:
+    start = utc_today()[1]
+
+    result = await (
+        sb.table('screening_records')
+        .select('modify_time')
+        .eq('spid', spid)
+        .gte('modify_time', start)
+        .order('modify_time', desc=False)
+        .limit(3000)
+        .execute()
+    )
+
+    return np.fromiter(
+        (parse_datetime(row['modify_time']).timestamp() for row in result.data or [] if row.get('modify_time')),
+        dtype=np.float64,
+    )
+
+
+def aggregate_gap_stats(timestamps: np.ndarray) -> GapStats:
+    """Sum 2-45 minute gaps between consecutive same-hour timestamps (UTC epoch seconds).
+
+    Input is sorted and spans a single day, so records sharing an hour bucket are
+    contiguous and the previous record in the same hour is simply the previous row.
+    """
+
+    if timestamps.size < 2:
+        return {}
+
+    hours = (timestamps // 3600).astype(np.int64) % 24
+    gaps = np.diff(timestamps) / 60
+    valid = (hours[1:] == hours[:-1]) & (gaps >= 2) & (gaps <= 45)
+
+    gap_hours = hours[1:][valid]
+    sums = np.bincount(gap_hours, weights=gaps[valid], minlength=24)
+    counts = np.bincount(gap_hours, minlength=24)
+    return {int(h): (float(sums[h]), int(counts[h])) for h in np.flatnonzero(counts)}
@@ -0,0 +1,29 @@
+from __future__ import annotations
+
+import os
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Environment is read once at import; restart the service after changing ai/.env.
+SUPABASE_URL = os.getenv('SUPABASE_URL')
+SUPABASE_SERVICE_ROLE_KEY = os.getenv('SUPABASE_SERVICE_ROLE_KEY')
+
+ALLOWED_ORIGINS = [origin.strip() for origin in os.getenv('ALLOWED_ORIGINS', 'http://localhost:5173').split(',') if origin.strip()]
+
+GEMINI_API_KEY = os.getenv('GEMINI_API_KEY')
+GEMINI_MODELS = tuple(
+    dict.fromkeys(
+        candidate.strip()
+        for candidate in (
+            os.getenv('GEMINI_MODEL'),
+            'gemini-2.0-flash-lite',
+            'gemini-2.0-flash',
+            'gemini-1.5-flash-latest',
+        )
+        if candidate and candidate.strip()
+    )
+)
+GEMINI_SERVICE_TIER = os.getenv('GEMINI_SERVICE_TIER', 'FLEX').strip().upper()
+ALLOW_GEMINI_FALLBACK = os.getenv('ALLOW_GEMINI_FALLBACK', 'true').lower() == 'true'
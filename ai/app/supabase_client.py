@@ -0,0 +1,27 @@
+from __future__ import annotations
+
+from supabase import AsyncClient, acreate_client
+
+from .settings import SUPABASE_SERVICE_ROLE_KEY, SUPABASE_URL
+
+_supabase: AsyncClient | None = None
+
+
+async def init_supabase() -> None:
+    global _supabase
+    if SUPABASE_URL and SUPABASE_SERVICE_ROLE_KEY:
+        _supabase = await acreate_client(SUPABASE_URL, SUPABASE_SERVICE_ROLE_KEY)
+
+
+async def close_supabase() -> None:
+    global _supabase
+    if _supabase is not None:
+        # Release the pooled PostgREST connections rather than leaving them to the GC.
+        await _supabase.postgrest.aclose()
+    _supabase = None
+
+
+async def get_supabase() -> AsyncClient:
+    if _supabase is None:
+        raise RuntimeError('SUPABASE_URL and SUPABASE_SERVICE_ROLE_KEY are required for AI service')
+    return _supabase
@@ -4,54 +4,154 @@ import argparse
 import math
 import os
 import re
+import time
+from collections.abc import Callable
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from datetime import datetime
 from typing import Any
 
+import httpx
+import numpy as np
+import orjson
 import pandas as pd
+import psycopg
+from pandas.api.types import (
+    infer_dtype,
+    is_bool_dtype,
+    is_datetime64_any_dtype,
+    is_float_dtype,
+    is_integer_dtype,
+)
 from dotenv import load_dotenv
+from postgrest import APIError
+from postgrest.types import ReturnMethod
+from psycopg.types.json import JsonbDumper
 from supabase import Client, create_client
 
 load_dotenv()
 
+PATIENT_BATCH_SIZE = 1000
+RECORD_BATCH_SIZE = 500
+INGEST_WORKERS = 8
+INGEST_RETRIES = 3
+INGEST_RETRY_BASE_SECONDS = 0.5
+# Raised before the request leaves the client, so the server cannot have applied the batch.
+UNSENT_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
+
+COPY_COLUMNS = (
+    'hnx',
+    'modify_time',
+    'spid',
+    'weight',
+    'height',
+    'bmi',
+    'sbp',
+    'dbp',
+    'chief_complaint',
+    'illness_detail',
+    'raw_payload',
+    'source',
+)
+
+_BP_RE = re.compile(r'^(\d{2,3})\s*/\s*(\d{2,3})$')
+_NORM_RE = re.compile(r'[^a-z0-9]+')
+
 
 def chunked(items: list[dict[str, Any]], size: int):
     for i in range(0, len(items), size):
         yield items[i : i + size]
 
 
-def parse_datetime(value: Any) -> str:
-    if pd.isna(value):
-        return datetime.utcnow().isoformat()
-    if isinstance(value, datetime):
-        return value.isoformat()
-    parsed = pd.to_datetime(value, errors='coerce')
-    if pd.isna(parsed):
-        return datetime.utcnow().isoformat()
-    return parsed.to_pydatetime().isoformat()
+def send_with_retry(
+    send: Callable[[list[dict[str, Any]]], Any],
+    batch: list[dict[str, Any]],
+    retry_on: tuple[type[Exception], ...],
+) -> Any:
+    for attempt in range(INGEST_RETRIES):
+        try:
+            return send(batch)
+        except retry_on:
+            if attempt == INGEST_RETRIES - 1:
+                raise
+            time.sleep(INGEST_RETRY_BASE_SECONDS * 2**attempt)
 
 
-def clean_num(value: Any) -> float | None:
-    if pd.isna(value):
-        return None
-    try:
-        n = float(value)
-    except (TypeError, ValueError):
-        return None
-    if math.isfinite(n):
-        return n
-    return None
+def send_batches(
+    send: Callable[[list[dict[str, Any]]], Any],
+    items: list[dict[str, Any]],
+    size: int,
+    retry_on: tuple[type[Exception], ...] = UNSENT_ERRORS,
+) -> list[Any]:
+    """Send batches on INGEST_WORKERS threads, retrying retry_on errors with backoff.
 
+    Only idempotent sends should retry errors that can occur after the server received
+    the batch (e.g. ReadTimeout); plain inserts would duplicate rows.
+    """
 
-def clean_int(value: Any) -> int | None:
-    num = clean_num(value)
-    if num is None:
-        return None
-    return int(round(num))
+    with ThreadPoolExecutor(max_workers=INGEST_WORKERS) as pool:
+        return list(pool.map(lambda batch: send_with_retry(send, batch, retry_on), chunked(items, size)))
+
+
+class OrjsonbDumper(JsonbDumper):
+    _dumps = orjson.dumps
+
+
+def insert_screening_batch(sb: Client, batch: list[dict[str, Any]]) -> None:
+    """POST one batch with an orjson-encoded body; supabase-py would run json.dumps over it."""
+
+    res = sb.postgrest.session.post(
+        'screening_records',
+        content=orjson.dumps(batch),
+        headers={'Content-Type': 'application/json', 'Prefer': 'return=minimal'},
+    )
+    if not res.is_success:
+        try:
+            error = orjson.loads(res.content)
+        except orjson.JSONDecodeError:
+            # Gateway errors (502/504) come back as HTML, not a PostgREST error object.
+            error = {'message': res.text, 'code': str(res.status_code)}
+        raise APIError(error)
+
+
+def copy_screening_records(db_url: str, columns: dict[str, list[Any]]) -> None:
+    """Stream the columns into screening_records with COPY in one transaction (triggers still run)."""
+
+    statement = f"copy public.screening_records ({', '.join(COPY_COLUMNS)}) from stdin"
+    with psycopg.connect(db_url) as conn:
+        conn.adapters.register_dumper(dict, OrjsonbDumper)
+        with conn.cursor() as cur, cur.copy(statement) as copy:
+            for row in zip(*(columns[col] for col in COPY_COLUMNS)):
+                copy.write_row(row)
+
+
+def parse_datetime(values: pd.Series) -> pd.Series:
+    parsed = pd.to_datetime(values, errors='coerce', utc=True, format='mixed')
+    parsed = parsed.fillna(pd.Timestamp.now(tz='UTC'))
+    return parsed.dt.strftime('%Y-%m-%dT%H:%M:%S.%f%z')
+
+
+def clean_num(values: pd.Series) -> pd.Series:
+    nums = pd.to_numeric(values, errors='coerce').astype('float64')
+    return nums.where(np.isfinite(nums))
+
+
+def clean_int(values: pd.Series) -> pd.Series:
+    return clean_num(values).round().astype('Int64')
+
+
+def clean_text(values: pd.Series) -> pd.Series:
+    return values.astype(str).str.strip().where(values.notna(), None)
+
+
+def to_python(values: pd.Series) -> list[Any]:
+    """Return native Python values with every missing value as None (JSON null)."""
+
+    return values.astype(object).where(values.notna(), None).tolist()
 
 
 def normalize_column_name(name: str) -> str:
-    return re.sub(r'[^a-z0-9]+', '_', str(name).strip().lower()).strip('_')
+    return _NORM_RE.sub('_', str(name).strip().lower()).strip('_')
 
 
 def clean_cell_value(value: Any) -> Any:
@@ -71,14 +171,77 @@ def clean_cell_value(value: Any) -> Any:
     return str(value).strip()
 
 
-def parse_bp(value: Any) -> tuple[int | None, int | None]:
-    if pd.isna(value):
-        return None, None
-    text = str(value).strip()
-    match = re.match(r'^(\d{2,3})\s*/\s*(\d{2,3})$', text)
-    if not match:
-        return None, None
-    return int(match.group(1)), int(match.group(2))
+def clean_column(values: pd.Series) -> list[Any]:
+    """Column-wise clean_cell_value; only mixed-type object columns fall back to per-cell cleaning."""
+
+    if is_bool_dtype(values) or is_integer_dtype(values):
+        return to_python(values)
+    if is_float_dtype(values):
+        return to_python(values.where(np.isfinite(values.astype('float64'))))
+    if is_datetime64_any_dtype(values):
+        return to_python(values.dt.strftime('%Y-%m-%dT%H:%M:%S.%f%z'))
+    kind = infer_dtype(values, skipna=True)
+    if kind == 'empty':
+        return [None] * len(values)
+    if kind == 'string':
+        return to_python(values.str.strip())
+    return [clean_cell_value(value) for value in values.tolist()]
+
+
+def parse_bp(values: pd.Series) -> tuple[pd.Series, pd.Series]:
+    parts = values.astype(str).str.strip().str.extract(_BP_RE)
+    return pd.to_numeric(parts[0]).astype('Int64'), pd.to_numeric(parts[1]).astype('Int64')
+
+
+def build_screening_columns(
+    subset: pd.DataFrame, hnx: pd.Series, resolved: dict[str, str]
+) -> dict[str, list[Any]]:
+    """Clean each screening_records column once and return them column-major.
+
+    hnx is the cleaned, index-aligned hnx column (the resolve_patient_id trigger fills
+    patient_id from it). COPY zips the columns straight into rows; only the REST path
+    builds per-row dicts via screening_rows.
+    """
+
+    def column(target: str) -> pd.Series:
+        if target in resolved:
+            return subset[resolved[target]]
+        return pd.Series(None, index=subset.index, dtype=object)
+
+    spid = clean_text(subset[resolved['spid']])
+
+    sbp = clean_int(column('sbp'))
+    dbp = clean_int(column('dbp'))
+    if 'bp' in resolved:
+        parsed_sbp, parsed_dbp = parse_bp(subset[resolved['bp']])
+        sbp = sbp.combine_first(parsed_sbp)
+        dbp = dbp.combine_first(parsed_dbp)
+
+    raw_columns = list(subset.columns)
+    raw_payloads = [
+        dict(zip(raw_columns, row))
+        for row in zip(*(clean_column(subset[col]) for col in raw_columns))
+    ]
+
+    return {
+        'hnx': hnx.tolist(),
+        'modify_time': parse_datetime(column('modify_time')).tolist(),
+        'spid': spid.where(spid.str.len() > 0, 'MED').tolist(),
+        'weight': to_python(clean_num(column('weight'))),
+        'height': to_python(clean_num(column('height'))),
+        'bmi': to_python(clean_num(column('bmi'))),
+        'sbp': to_python(sbp),
+        'dbp': to_python(dbp),
+        'chief_complaint': to_python(clean_text(column('chief_complaint'))),
+        'illness_detail': to_python(clean_text(column('illness_detail'))),
+        'raw_payload': raw_payloads,
+        'source': ['import'] * len(hnx),
+    }
+
+
+def screening_rows(columns: dict[str, list[Any]]) -> list[dict[str, Any]]:
+    keys = list(columns)
+    return [dict(zip(keys, values)) for values in zip(*columns.values())]
 
 
 def main() -> None:
@@ -99,9 +262,11 @@ def main() -> None:
     ext = file_path.suffix.lower()
 
     if ext == '.csv':
-        df = pd.read_csv(args.file, encoding='utf-8-sig')
+        df = pd.read_csv(args.file, encoding='utf-8-sig', dtype_backend='pyarrow', nrows=args.limit)
     elif ext in ('.xlsx', '.xlsm', '.xls'):
-        df = pd.read_excel(args.file, sheet_name=args.sheet)
+        df = pd.read_excel(
+            args.file, sheet_name=args.sheet, engine='calamine', dtype_backend='pyarrow', nrows=args.limit
+        )
     else:
         raise RuntimeError('Unsupported file type. Use .csv, .xlsx, .xlsm, or .xls')
 
@@ -132,59 +297,28 @@ def main() -> None:
     if missing:
         raise RuntimeError(f'Missing required columns in excel: {missing}')
 
-    subset = df.head(args.limit).copy()
-    subset = subset[subset[resolved['hnx']].notna()]
+    hnx = df[resolved['hnx']].astype('string').str.strip()
+    has_hnx = (hnx.str.len() > 0).fillna(False)
+    subset, hnx = df[has_hnx], hnx[has_hnx]
 
-    unique_hnx = sorted({str(v).strip() for v in subset[resolved['hnx']].tolist() if str(v).strip()})
+    unique_hnx = sorted(hnx.unique())
 
     print(f'Upserting patients: {len(unique_hnx)}')
-    for batch in chunked([{'hnx': h} for h in unique_hnx], 500):
-        sb.table('patients').upsert(batch, on_conflict='hnx').execute()
-
-    patient_rows = sb.table('patients').select('id,hnx').in_('hnx', unique_hnx).execute().data or []
-    patient_by_hnx = {row['hnx']: row['id'] for row in patient_rows}
-
-    inserts: list[dict[str, Any]] = []
-    for _, row in subset.iterrows():
-        hnx = str(row[resolved['hnx']]).strip()
-        patient_id = patient_by_hnx.get(hnx)
-        if not patient_id:
-            continue
-
-        sbp = clean_int(row[resolved['sbp']]) if 'sbp' in resolved else None
-        dbp = clean_int(row[resolved['dbp']]) if 'dbp' in resolved else None
-        if (sbp is None or dbp is None) and 'bp' in resolved:
-            parsed_sbp, parsed_dbp = parse_bp(row[resolved['bp']])
-            if sbp is None:
-                sbp = parsed_sbp
-            if dbp is None:
-                dbp = parsed_dbp
-
-        raw_payload = {
-            col: clean_cell_value(val)
-            for col, val in row.to_dict().items()
-        }
-
-        record = {
-            'patient_id': patient_id,
-            'hnx': hnx,
-            'modify_time': parse_datetime(row[resolved['modify_time']]),
-            'spid': str(row[resolved['spid']]).strip() or 'MED',
-            'weight': clean_num(row[resolved['weight']]) if 'weight' in resolved else None,
-            'height': clean_num(row[resolved['height']]) if 'height' in resolved else None,
-            'bmi': clean_num(row[resolved['bmi']]) if 'bmi' in resolved else None,
-            'sbp': sbp,
-            'dbp': dbp,
-            'chief_complaint': str(row[resolved['chief_complaint']]).strip() if 'chief_complaint' in resolved and pd.notna(row[resolved['chief_complaint']]) else None,
-            'illness_detail': str(row[resolved['illness_detail']]).strip() if 'illness_detail' in resolved and pd.notna(row[resolved['illness_detail']]) else None,
-            'raw_payload': raw_payload,
-            'source': 'import',
-        }
-        inserts.append(record)
-
-    print(f'Inserting screening records: {len(inserts)}')
-    for batch in chunked(inserts, 500):
-        sb.table('screening_records').insert(batch).execute()
+    send_batches(
+        lambda batch: sb.table('patients').upsert(batch, on_conflict='hnx', returning=ReturnMethod.minimal).execute(),
+        [{'hnx': h} for h in unique_hnx],
+        PATIENT_BATCH_SIZE,
+        retry_on=(httpx.TransportError,),
+    )
+
+    columns = build_screening_columns(subset, hnx, resolved)
+
+    print(f"Inserting screening records: {len(columns['hnx'])}")
+    db_url = os.getenv('SUPABASE_DB_URL')
+    if db_url:
+        copy_screening_records(db_url, columns)
+    else:
+        send_batches(lambda batch: insert_screening_batch(sb, batch), screening_rows(columns), RECORD_BATCH_SIZE)
 
     print('Import completed.')
 
@@ -31,6 +31,7 @@ create table if not exists public.screening_records (
 create index if not exists idx_screening_hnx on public.screening_records(hnx);
 create index if not exists idx_screening_modify_time on public.screening_records(modify_time);
 create index if not exists idx_screening_spid on public.screening_records(spid);
+create index if not exists idx_screening_spid_modify_time on public.screening_records(spid, modify_time);
 
 create table if not exists public.doctors (
   id uuid primary key default gen_random_uuid(),
@@ -125,6 +126,58 @@ as $$
   select role from public.profiles where id = auth.uid()
 $$;
 
+-- bulk imports send hnx only; resolve patient_id through the unique patients.hnx index.
+create or replace function public.resolve_patient_id()
+returns trigger
+language plpgsql
+as $$
+begin
+  if new.patient_id is null then
+    select p.id into new.patient_id from public.patients p where p.hnx = new.hnx;
+  end if;
+  return new;
+end;
+$$;
+
+drop trigger if exists trg_screening_resolve_patient_id on public.screening_records;
+create trigger trg_screening_resolve_patient_id
+before insert on public.screening_records
+for each row execute function public.resolve_patient_id();
+
+-- per-hour gaps (minutes) between consecutive screenings today, per SPID, used by the AI service.
+-- plpgsql caches the query plan per connection, so repeat calls skip parse/plan.
+create or replace function public.avg_service_gap(
+  p_spids text[],
+  p_day date default (now() at time zone 'utc')::date
+)
+returns table(spid text, hour int, avg_gap double precision, samples int)
+language plpgsql
+stable
+as $$
+begin
+  return query
+  with g as (
+    select
+      s.spid as sp,
+      extract(hour from s.modify_time at time zone 'utc')::int as h,
+      extract(epoch from (
+        s.modify_time - lag(s.modify_time) over (
+          partition by s.spid, extract(hour from s.modify_time at time zone 'utc')
+          order by s.modify_time
+        )
+      )) / 60 as gap
+    from public.screening_records s
+    where s.spid = any(p_spids)
+      and s.modify_time >= p_day::timestamp at time zone 'utc'
+      and s.modify_time < (p_day + 1)::timestamp at time zone 'utc'
+  )
+  select g.sp, g.h, avg(g.gap)::double precision, count(*)::int
+  from g
+  where g.gap between 2 and 45
+  group by g.sp, g.h;
+end;
+$$;
+
 -- profiles
 drop policy if exists "profiles_self_select" on public.profiles;
 create policy "profiles_self_select"